@@ -21,6 +21,7 @@ class Config:
     USER_AGENT: str = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
 
     MAX_ITERATIONS: int = 50
+    POOL_SIZE: int = int(os.getenv("POOL_SIZE", "1"))
 
     BROWSER_ARGS: List[str] = field(default_factory=lambda: [
         "--disable-blink-features=AutomationControlled",
@@ -1,28 +1,42 @@
 import asyncio
+import httpx
+from typing import List
 from rich.console import Console
 from aioconsole import ainput
 
-from src.agent import Agent
-from src.browser import BrowserService
+from src.agent import Agent, create_http_client
+from src.browser import BrowserService, TabPool
+from config import cfg
 
 console = Console()
 
 
+async def run_in_parallel(pool: TabPool, http_client: httpx.AsyncClient, tasks: List[str]):
+    async def run_one(task: str):
+        async with pool.tab() as tab, Agent(tab, http_client) as agent:
+            await agent.run(task)
+
+    await asyncio.gather(*[run_one(task) for task in tasks])
+
+
 async def main():
     browser = BrowserService()
+    pool = TabPool(browser, cfg.POOL_SIZE)
+    http_client = create_http_client()
 
     try:
         await browser.start()
-        agent = Agent(browser)
+        await pool.start()
 
-        console.print("[bold green]System Ready. Browser launched.[/bold green]")
+        console.print(f"[bold green]System Ready. Browser launched ({pool.size} tab(s)).[/bold green]")
 
         while True:
-            task = await ainput("\nEnter task (q to exit): ")
+            task = await ainput("\nEnter task, split parallel tasks with '||' (q to exit): ")
             if task.lower() in ['q', 'exit']:
                 break
 
-            await agent.run(task)
+            tasks = [t.strip() for t in task.split("||") if t.strip()]
+            await run_in_parallel(pool, http_client, tasks)
 
     except KeyboardInterrupt:
         print("\nGoodbye!")
@@ -30,7 +44,9 @@ async def main():
         console.print(f"[bold red]Critical Error: {e}[/bold red]")
     finally:
         console.print("Stopping browser...")
+        await pool.stop()
         await browser.stop()
+        await http_client.aclose()
 
 
 if __name__ == "__main__":
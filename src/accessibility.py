@@ -1,5 +1,8 @@
-from typing import Dict, Any, List
-from dataclasses import dataclass
+import io
+from typing import Dict, Any, List, Tuple, Optional
+from dataclasses import dataclass, replace
+
+_INTERACTIVE, _HEADING, _CONTENT = 1, 2, 4
 
 
 @dataclass
@@ -8,6 +11,9 @@ class ElementInfo:
     role: str
     name: str
     attributes: str = ""
+    backend_node_id: Optional[int] = None
+    # accessible name before the "[Value: ...]" substitution; diff matches on it
+    raw_name: str = ""
 
 
 class AccessibilityParser:
@@ -16,93 +22,155 @@ class AccessibilityParser:
         'checkbox', 'radio', 'slider', 'tab', 'menuitem', 'switch', 'treeitem'
     }
 
-    CONTEXT_ROLES = {'heading', 'img', 'statictext', 'text', 'paragraph', 'listitem'}
+    CONTEXT_ROLES = {'heading', 'img', 'StaticText', 'statictext', 'text', 'paragraph', 'listitem'}
+
+    # role -> one of the _INTERACTIVE/_HEADING/_CONTENT flags; unlisted roles are skipped
+    ROLE_CLASS = {**dict.fromkeys(CONTEXT_ROLES, _CONTENT), **dict.fromkeys(INTERACTIVE_ROLES, _INTERACTIVE),
+                  'heading': _HEADING}
+
+    _CURRENCY = frozenset('₽$€')
 
     def __init__(self):
         self.elements_map: Dict[int, ElementInfo] = {}
 
-    async def scan(self, page) -> str:
+    async def scan(self, cdp) -> str:
         self.elements_map.clear()
         try:
-            snapshot = await page.accessibility.snapshot(interesting_only=False)
+            tree = await cdp.send("Accessibility.getFullAXTree")
         except Exception as e:
             return f"Error scanning page: {e}"
 
-        if not snapshot:
+        nodes = tree.get("nodes")
+        if not nodes:
             return "Accessibility tree is empty."
 
-        report_lines = []
-        self._traverse(snapshot, report_lines)
+        report = io.StringIO()
+        self._traverse(nodes, report)
 
-        if not report_lines:
+        if not report.tell():
             return "No interactive elements found. Try scrolling."
 
-        return f"Interactive Elements ({len(self.elements_map)} items):\n" + "\n".join(report_lines)
-
-    def _traverse(self, node: Dict[str, Any], report: List[str]):
-        if len(self.elements_map) >= 800:
-            return
-
-        role = node.get("role", "generic")
-        name = node.get("name", "").strip()
-        children = node.get("children", [])
-
-        value = node.get("value")
-        checked = node.get("checked")
-        level = node.get("level")
-        disabled = node.get("disabled")
-
-        if not name and children and role in self.INTERACTIVE_ROLES:
-            name = self._collect_text(children)
-
-        is_interactive = role in self.INTERACTIVE_ROLES
-        is_heading = role == 'heading'
-        is_content = role in self.CONTEXT_ROLES and name and len(name) > 2
-
-        if not (is_interactive or is_heading or is_content):
-            for child in children:
-                self._traverse(child, report)
-            return
-
-        attrs = []
-        if role in ['textbox', 'searchbox'] and not name and value:
-            name = f"[Value: {value}]"
-        if value and str(value) != str(name): attrs.append(f"val={value}")
-        if checked: attrs.append("checked")
-        if disabled: attrs.append("disabled")
-        if level: attrs.append(f"h{level}")
-
-        attr_str = f" ({', '.join(attrs)})" if attrs else ""
-
-        display_name = name.replace("\n", " ")
-        if len(display_name) > 80:
-            display_name = display_name[:77] + "..."
-
-        el_id = None
-        prefix = "  -"
-
-        if is_interactive:
-            el_id = len(self.elements_map) + 1
-            self.elements_map[el_id] = ElementInfo(id=el_id, role=role, name=name)
-            prefix = f"{el_id}."
-
-        if is_heading:
-            report.append(f"\n=== {role.upper()} {display_name} ===")
-        elif el_id:
-            report.append(f"{prefix} [{role}] {display_name}{attr_str}")
-        else:
-            if any(x in display_name for x in ['₽', '$', '€']) or len(display_name) > 20:
-                report.append(f"    (txt) {display_name}")
-
-        for child in children:
-            self._traverse(child, report)
-
-    def _collect_text(self, children: List[Dict]) -> str:
+        return f"Interactive Elements ({len(self.elements_map)} items):\n" + report.getvalue().rstrip("\n")
+
+    def _traverse(self, nodes: List[Dict[str, Any]], report: io.StringIO):
+        """
+        Walks the flat CDP node list from the root via childIds.
+        Ignored nodes are transparent; text below a named control or heading
+        is already part of its name, so it is not repeated (covered).
+        """
+        write = report.write
+        role_class = self.ROLE_CLASS
+        elements = self.elements_map
+        currency = self._CURRENCY
+        by_id = {node["nodeId"]: node for node in nodes}
+        empty: Dict[str, Any] = {}
+
+        stack: List[Tuple[Dict[str, Any], bool]] = [(nodes[0], False)]
+        while stack and len(elements) < 800:
+            node, covered = stack.pop()
+
+            child_ids = node.get("childIds")
+            role = node.get("role", empty).get("value", "generic")
+            cls = 0 if node.get("ignored") else role_class.get(role, 0)
+            if not cls:
+                if child_ids:
+                    stack.extend((by_id[c], covered) for c in reversed(child_ids) if c in by_id)
+                continue
+
+            name = str(node.get("name", empty).get("value", "")).strip()
+            if cls == _INTERACTIVE and not name and child_ids:
+                name = self._collect_text(child_ids, by_id)
+            # Pushed only once the name is final, so text collected above is not repeated as (txt)
+            if child_ids:
+                child_covered = covered or (cls != _CONTENT and bool(name))
+                stack.extend((by_id[c], child_covered) for c in reversed(child_ids) if c in by_id)
+
+            if cls == _INTERACTIVE:
+                props = {p["name"]: p["value"].get("value") for p in node.get("properties", ())}
+                value = node.get("value", empty).get("value")
+                attrs = []
+                raw_name = name
+                if role in ['textbox', 'searchbox'] and not name and value:
+                    name = f"[Value: {value}]"
+                if value and str(value) != str(name): attrs.append(f"val={value}")
+                if props.get("checked") in ("true", "mixed"): attrs.append("checked")
+                if props.get("disabled"): attrs.append("disabled")
+                if props.get("level"): attrs.append(f"h{props['level']}")
+
+                attr_str = f" ({', '.join(attrs)})" if attrs else ""
+
+                el_id = len(elements) + 1
+                elements[el_id] = ElementInfo(id=el_id, role=role, name=name, attributes=attr_str,
+                                              backend_node_id=node.get("backendDOMNodeId"), raw_name=raw_name)
+                write(f"{el_id}. [{role}] {self._display_name(name)}{attr_str}\n")
+            elif cls == _HEADING:
+                write(f"\n=== HEADING {self._display_name(name)} ===\n")
+            elif not covered and len(name) > 2:
+                display_name = self._display_name(name)
+                if len(display_name) > 20 or not currency.isdisjoint(display_name):
+                    write(f"    (txt) {display_name}\n")
+
+    def _collect_text(self, child_ids: List[str], by_id: Dict[str, Dict[str, Any]]) -> str:
         text = []
-        for child in children:
-            name = child.get("name", "").strip()
+        stack = [c for c in reversed(child_ids) if c in by_id]
+        while stack:
+            child = by_id[stack.pop()]
+            name = str(child.get("name", {}).get("value", "")).strip()
             if name:
                 text.append(name)
             else:
-                text.append(self._collect_text(child.get("children", [])))
-        return " ".join([t for t in text if t]).strip()
\ No newline at end of file
+                stack.extend(c for c in reversed(child.get("childIds") or ()) if c in by_id)
+        return " ".join(text)
+
+    def diff(self, previous: Dict[int, ElementInfo]) -> str:
+        """
+        Compares the fresh scan against the previous elements map.
+        Unchanged elements keep their previous IDs, new ones get fresh IDs,
+        so IDs the model already saw stay valid. Elements are matched on
+        role and raw name, so typing into an unnamed textbox is a CHANGE.
+        """
+        unmatched: Dict[Tuple[str, str], List[ElementInfo]] = {}
+        for el in previous.values():
+            unmatched.setdefault((el.role, el.raw_name), []).append(el)
+
+        next_id = max(previous, default=0) + 1
+        current: Dict[int, ElementInfo] = {}
+        added, changed = [], []
+
+        for el in self.elements_map.values():
+            matches = unmatched.get((el.role, el.raw_name))
+            if matches:
+                old = matches.pop(0)
+                el = replace(el, id=old.id)
+                if el.attributes != old.attributes:
+                    changed.append(el)
+            else:
+                el = replace(el, id=next_id)
+                next_id += 1
+                added.append(el)
+            current[el.id] = el
+
+        self.elements_map = current
+        removed = [el for els in unmatched.values() for el in els]
+
+        if not (added or changed or removed):
+            return f"No changes since last scan ({len(current)} items). Previous IDs are still valid."
+
+        lines = [f"Changes since last scan ({len(current)} items, unchanged IDs are still valid):"]
+        if added:
+            lines.append("ADDED:")
+            lines.extend(f"{el.id}. [{el.role}] {self._display_name(el.name)}{el.attributes}" for el in added)
+        if changed:
+            lines.append("CHANGED:")
+            lines.extend(f"{el.id}. [{el.role}] {self._display_name(el.name)}{el.attributes}" for el in changed)
+        if removed:
+            lines.append("REMOVED:")
+            lines.extend(f"[{el.role}] {self._display_name(el.name)}" for el in removed)
+        return "\n".join(lines)
+
+    @staticmethod
+    def _display_name(name: str) -> str:
+        display_name = name.replace("\n", " ")
+        if len(display_name) > 80:
+            display_name = display_name[:77] + "..."
+        return display_name
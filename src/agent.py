@@ -1,7 +1,13 @@
-import json
 import asyncio
+import contextlib
+from collections import deque
+import hashlib
+import importlib.util
+import httpx
+import orjson
 import tiktoken
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple, Optional, Deque
+from aioconsole import ainput
 from openai import AsyncOpenAI
 from rich.console import Console
 from rich.panel import Panel
@@ -12,11 +18,89 @@ from .browser import BrowserService
 
 console = Console()
 
+
+def create_http_client() -> httpx.AsyncClient:
+    """Keep-alive HTTP/2 client; share one between agents so they multiplex a single connection."""
+    http2 = importlib.util.find_spec("h2") is not None
+    if not http2:
+        console.print("[dim yellow]'h2' is not installed, falling back to HTTP/1.1 (pip install -r requirements.txt).[/dim yellow]")
+    return httpx.AsyncClient(
+        http2=http2,
+        timeout=httpx.Timeout(60.0),
+        limits=httpx.Limits(max_keepalive_connections=16, max_connections=32)
+    )
+
+
 class Agent:
-    def __init__(self, browser: BrowserService):
-        self.client = AsyncOpenAI(api_key=cfg.API_KEY, base_url=cfg.BASE_URL)
+    TOKEN_LIMIT = 100000
+
+    # Shared by all agents so parallel tasks ask their questions one at a time
+    _ask_lock = asyncio.Lock()
+
+    _TOOLS_PLANNER: List[dict] = [{
+        "type": "function",
+        "function": {
+            "name": "set_plan",
+            "description": "Set execution steps.",
+            "parameters": {"type": "object",
+                           "properties": {"steps": {"type": "array", "items": {"type": "string"}}},
+                           "required": ["steps"]}
+        }
+    }, {
+        "type": "function",
+        "function": {
+            "name": "ask_user",
+            "description": "Ask clarification.",
+            "parameters": {"type": "object", "properties": {"question": {"type": "string"}},
+                           "required": ["question"]}
+        }
+    }]
+
+    _TOOLS_WORKER: List[dict] = [
+        {"type": "function", "function": {"name": "open_url", "parameters": {"type": "object", "properties": {
+            "url": {"type": "string"}}, "required": ["url"]}}},
+        {"type": "function", "function": {"name": "scan_page",
+                                          "description": "Get interactive elements map.",
+                                          "parameters": {"type": "object", "properties": {
+                                              "diff": {"type": "boolean",
+                                                       "description": "Only return elements added/changed/removed since the previous scan? Default False"}}}}},
+        {"type": "function", "function": {"name": "get_last_scan",
+                                          "description": "Re-read an earlier scan by its scan# id. IDs in it may be outdated.",
+                                          "parameters": {"type": "object", "properties": {
+                                              "scan_id": {"type": "string"},
+                                              "offset": {"type": "integer", "description": "Character offset for long scans. Default 0"}},
+                                                         "required": ["scan_id"]}}},
+        {"type": "function", "function": {"name": "click_element", "parameters": {"type": "object", "properties": {
+            "element_id": {"type": "integer"}}, "required": ["element_id"]}}},
+        {"type": "function", "function": {"name": "type_text", "parameters": {"type": "object", "properties": {
+            "element_id": {"type": "integer"}, "text": {"type": "string"},
+            "submit": {"type": "boolean", "description": "Press Enter after typing? Default True"}},
+                                                                              "required": ["element_id", "text"]}}},
+        {"type": "function", "function": {"name": "scroll", "parameters": {"type": "object", "properties": {
+            "direction": {"type": "string", "enum": ["up", "down"]}}, "required": ["direction"]}}},
+        {"type": "function",
+         "function": {"name": "mark_step_done", "description": "Call when step is done.",
+                      "parameters": {"type": "object", "properties": {"result_summary": {"type": "string"}},
+                                     "required": ["result_summary"]}}},
+        {"type": "function",
+         "function": {"name": "finish_task", "description": "Call when ALL steps are done.",
+                      "parameters": {"type": "object", "properties": {"final_result": {"type": "string"}},
+                                     "required": ["final_result"]}}},
+        {"type": "function", "function": {"name": "get_tabs", "parameters": {"type": "object", "properties": {}}}},
+        {"type": "function", "function": {"name": "switch_tab", "parameters": {"type": "object", "properties": {
+            "idx": {"type": "integer"}}, "required": ["idx"]}}},
+        {"type": "function", "function": {"name": "close_tab", "parameters": {"type": "object", "properties": {}}}}
+    ]
+
+    def __init__(self, browser: BrowserService, http_client: Optional[httpx.AsyncClient] = None):
+        self._owns_http = http_client is None
+        self._http = http_client or create_http_client()
+        self.client = AsyncOpenAI(api_key=cfg.API_KEY, base_url=cfg.BASE_URL, http_client=self._http)
         self.browser = browser
-        self.history: List[Dict[str, Any]] = []
+        # history is a token window: _tok_counts runs parallel to it and _tok_sum is their total
+        self.history: Deque[Dict[str, Any]] = deque()
+        self._tok_counts: Deque[int] = deque()
+        self._tok_sum = 0
         self.plan: List[str] = []
         self.notes: List[str] = []
         self.main_goal: str = ""
@@ -25,12 +109,22 @@ class Agent:
         self.last_action = None
         self.repeated_action_count = 0
 
+        try:
+            self._enc = tiktoken.encoding_for_model(cfg.MODEL_NAME)
+        except Exception:
+            self._enc = tiktoken.get_encoding("cl100k_base")
+
+        # Only the newest scan stays in history verbatim, older ones are stubbed out
+        self._scan_store: Dict[str, str] = {}
+        self._last_scan: Optional[Tuple[Dict[str, Any], str]] = None
+
         self.tools_map = {
             "mark_step_done": self._tool_mark_done,
             "finish_task": self._tool_finish,
             "ask_user": self._tool_ask_user,
             "open_url": self.browser.open_url,
             "scan_page": self.browser.scan_page,
+            "get_last_scan": self._tool_get_last_scan,
             "click_element": self.browser.click_element,
             "type_text": self.browser.type_text,
             "scroll": self.browser.scroll,
@@ -42,9 +136,11 @@ class Agent:
     async def run(self, task: str):
         self.main_goal = task
         self.plan = []
-        self.history = []
+        self._reset_history()
         self.notes = []
         self.has_planned = False
+        self._scan_store = {}
+        self._last_scan = None
 
         self.last_action = None
         self.repeated_action_count = 0
@@ -52,8 +148,6 @@ class Agent:
         console.print(Panel(f"[bold cyan]Task:[/bold cyan] {task}", title="🤖 New Mission"))
 
         for i in range(cfg.MAX_ITERATIONS):
-            self._prune_history()
-
             if not self.plan and not self.has_planned:
                 role = "PLANNER"
             else:
@@ -62,122 +156,229 @@ class Agent:
             console.rule(f"Step {i + 1} | Role: {role}")
 
             try:
-                response = await self.client.chat.completions.create(
-                    model=cfg.MODEL_NAME,
-                    messages=[{"role": "system", "content": self._get_system_prompt(role)}] + self.history,
-                    tools=self._get_tool_definitions(role),
-                    tool_choice="auto"
-                )
+                msg, prewarm = await self._stream_completion(role)
             except Exception as e:
                 console.print(f"[bold red]API Error: {e}[/bold red]")
                 await asyncio.sleep(5)
                 continue
 
-            msg = response.choices[0].message
-            self.history.append(msg.model_dump())
+            self._append_history(msg)
 
-            if msg.content:
-                console.print(Panel(Markdown(msg.content), title="🧠 Thought", style="yellow"))
+            if msg["content"]:
+                console.print(Panel(Markdown(msg["content"]), title="🧠 Thought", style="yellow"))
 
-            if not msg.tool_calls:
+            if not msg.get("tool_calls"):
                 console.print("[dim magenta]No tools called.[/dim magenta]")
                 if role == "PLANNER":
-                     self.history.append({"role": "user", "content": "You must call 'set_plan' or 'ask_user'."})
+                     self._append_history({"role": "user", "content": "You must call 'set_plan' or 'ask_user'."})
                 else:
-                     self.history.append({"role": "user", "content": "Action required. Please call a tool to proceed."})
+                     self._append_history({"role": "user", "content": "Action required. Please call a tool to proceed."})
                 continue
 
             reset_context = False
 
-            for tool_call in msg.tool_calls:
-                fname = tool_call.function.name
-                args_str = tool_call.function.arguments
-                console.print(f"🔧 Call: [bold green]{fname}[/bold green] {args_str[:100]}")
-
-                try:
-                    args = json.loads(args_str)
-
-                    if fname == "set_plan":
-                        self.plan = args.get("steps", [])
-                        console.print(Panel(f"Plan set: {self.plan}", title="📝 Plan Updated", style="green"))
-                        self.history = []
-                        self.has_planned = True
-                        reset_context = True
-                        break
-
-                    if fname == "finish_task":
-                        console.print(Panel(args.get("final_result", "Done"), title="🏁 Done", style="green"))
-                        return
-
-                    current_action = (fname, str(args))
-
-                    if current_action == self.last_action:
-                        self.repeated_action_count += 1
-                    else:
-                        self.repeated_action_count = 0
-
-                    if self.repeated_action_count >= 3:
-                        result = "⛔ SYSTEM OVERRIDE: You are looping the exact same action 3 times. STOP. You MUST choose a DIFFERENT tool or strategy."
-                        console.print(f"[bold red]{result}[/bold red]")
-                    else:
-                        func = self.tools_map.get(fname)
-                        if func:
-                            if asyncio.iscoroutinefunction(func):
-                                result = await func(**args)
-                            else:
-                                result = func(**args)
+            try:
+                for idx, tool_call in enumerate(msg["tool_calls"]):
+                    if idx and prewarm:
+                        # An unused pre-warmed scan must finish before later calls touch the elements map
+                        await self._settle(prewarm[1])
+
+                    fname = tool_call["function"]["name"]
+                    args_str = tool_call["function"]["arguments"]
+                    console.print(f"🔧 Call: [bold green]{fname}[/bold green] {args_str[:100]}")
+
+                    try:
+                        args = orjson.loads(args_str)
+
+                        if fname == "set_plan":
+                            self.plan = args.get("steps", [])
+                            console.print(Panel(f"Plan set: {self.plan}", title="📝 Plan Updated", style="green"))
+                            self._reset_history()
+                            self.has_planned = True
+                            reset_context = True
+                            break
+
+                        if fname == "finish_task":
+                            console.print(Panel(args.get("final_result", "Done"), title="🏁 Done", style="green"))
+                            return
+
+                        current_action = (fname, str(args))
+
+                        if current_action == self.last_action:
+                            self.repeated_action_count += 1
                         else:
-                            result = f"Error: Tool {fname} not found"
-
-                    if "Error" in str(result) or "fail" in str(result).lower():
-                        result += self._get_error_hint(fname, str(result))
+                            self.repeated_action_count = 0
 
-                    self.last_action = current_action
-
-                except Exception as e:
-                    result = f"Error executing {fname}: {e}"
-                    console.print(f"[red]{result}[/red]")
-
-                if not reset_context:
-                    self._add_tool_result(tool_call.id, str(result))
+                        if self.repeated_action_count >= 3:
+                            result = "⛔ SYSTEM OVERRIDE: You are looping the exact same action 3 times. STOP. You MUST choose a DIFFERENT tool or strategy."
+                            console.print(f"[bold red]{result}[/bold red]")
+                        elif idx == 0 and prewarm and prewarm[0] == args:
+                            result = await prewarm[1]
+                        else:
+                            func = self.tools_map.get(fname)
+                            if func:
+                                if asyncio.iscoroutinefunction(func):
+                                    result = await func(**args)
+                                else:
+                                    result = func(**args)
+                            else:
+                                result = f"Error: Tool {fname} not found"
+
+                        if "Error" in str(result) or "fail" in str(result).lower():
+                            result += self._get_error_hint(fname, str(result))
+
+                        self.last_action = current_action
+
+                    except Exception as e:
+                        result = f"Error executing {fname}: {e}"
+                        console.print(f"[red]{result}[/red]")
+
+                    if not reset_context:
+                        self._add_tool_result(tool_call["id"], str(result), fname)
+            finally:
+                if prewarm:
+                    await self._settle(prewarm[1])
+
+    async def _stream_completion(self, role: str) -> Tuple[Dict[str, Any], Optional[Tuple[Dict[str, Any], asyncio.Task]]]:
+        """
+        Streams the completion and assembles the assistant message.
+        A leading scan_page call is started as soon as its arguments parse,
+        so the scan overlaps the rest of the generation.
+        """
+        stream = await self.client.chat.completions.create(
+            model=cfg.MODEL_NAME,
+            messages=[{"role": "system", "content": self._get_system_prompt(role)}] + list(self.history),
+            tools=self._get_tool_definitions(role),
+            tool_choice="auto",
+            stream=True
+        )
+
+        content: List[str] = []
+        calls: Dict[int, Dict[str, Any]] = {}
+        prewarm = None
 
-    def _prune_history(self):
         try:
-            enc = tiktoken.encoding_for_model(cfg.MODEL_NAME)
-        except:
-            enc = tiktoken.get_encoding("cl100k_base")
-
-        total_tokens = 0
-        kept_messages = []
-        TOKEN_LIMIT = 100000
-
-        for msg in reversed(self.history):
-            msg_content = str(msg.get("content") or "")
-            if msg.get("tool_calls"):
-                msg_content += str(msg["tool_calls"])
-
-            msg_tokens = len(enc.encode(msg_content))
-
-            if total_tokens + msg_tokens > TOKEN_LIMIT:
-                break
-
-            total_tokens += msg_tokens
-            kept_messages.append(msg)
-
-        self.history = list(reversed(kept_messages))
-
-    def _add_tool_result(self, tool_id: str, result: str):
+            async for chunk in stream:
+                if not chunk.choices: continue
+                delta = chunk.choices[0].delta
+
+                if delta.content:
+                    content.append(delta.content)
+
+                for tc in delta.tool_calls or ():
+                    call = calls.setdefault(tc.index, {"id": "", "type": "function",
+                                                       "function": {"name": "", "arguments": ""}})
+                    if tc.id: call["id"] = tc.id
+                    if tc.function:
+                        if tc.function.name: call["function"]["name"] += tc.function.name
+                        if tc.function.arguments: call["function"]["arguments"] += tc.function.arguments
+
+                    if prewarm is None and tc.index == 0 and call["function"]["name"] == "scan_page":
+                        prewarm = self._prewarm_scan(call["function"]["arguments"])
+        except Exception:
+            if prewarm:
+                await self._settle(prewarm[1])
+            raise
+
+        msg: Dict[str, Any] = {"role": "assistant", "content": "".join(content) or None}
+        if calls:
+            msg["tool_calls"] = [calls[i] for i in sorted(calls)]
+        return msg, prewarm
+
+    def _prewarm_scan(self, args_str: str) -> Optional[Tuple[Dict[str, Any], asyncio.Task]]:
+        try:
+            args = orjson.loads(args_str)
+            if ("scan_page", str(args)) == self.last_action and self.repeated_action_count >= 2:
+                return None  # The loop guard will override this call; don't touch the page
+            return args, asyncio.create_task(self.browser.scan_page(**args))
+        except (orjson.JSONDecodeError, TypeError):
+            return None
+
+    @staticmethod
+    async def _settle(task: asyncio.Task):
+        # Awaited, not cancelled: an interrupted scan would leave the parser's elements map half-built
+        with contextlib.suppress(Exception):
+            await task
+
+    async def close(self):
+        if self._owns_http:
+            await self._http.aclose()
+
+    async def __aenter__(self) -> "Agent":
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def _reset_history(self):
+        self.history = deque()
+        self._tok_counts = deque()
+        self._tok_sum = 0
+
+    def _append_history(self, msg: Dict[str, Any]):
+        """Appends msg and evicts the oldest messages until the window fits TOKEN_LIMIT."""
+        tokens = len(self._enc.encode(self._message_text(msg)))
+        self.history.append(msg)
+        self._tok_counts.append(tokens)
+        self._tok_sum += tokens
+
+        # A tool result without its assistant tool_calls message is rejected by the API,
+        # so a leading one goes even when it is the only message left
+        while self.history and (self.history[0].get("role") == "tool"
+                                or (len(self.history) > 1 and self._tok_sum > self.TOKEN_LIMIT)):
+            self.history.popleft()
+            self._tok_sum -= self._tok_counts.popleft()
+
+    @staticmethod
+    def _message_text(msg: Dict[str, Any]) -> str:
+        msg_content = str(msg.get("content") or "")
+        if msg.get("tool_calls"):
+            msg_content += str(msg["tool_calls"])
+        return msg_content
+
+    def _add_tool_result(self, tool_id: str, result: str, fname: str = ""):
         display_res = result if len(result) < 200 else f"...large output ({len(result)} chars)..."
         console.print(f"   ℹ️ Result: [dim]{display_res}[/dim]")
 
-        if len(result) > 20000:
-            result = result[:2000] + "\n...[TRUNCATED DUE TO LENGTH]... Call scan_page again if needed."
-
-        self.history.append({
+        scan_id = None
+        if fname == "scan_page" and result.startswith("Interactive Elements"):
+            self._stash_last_scan()
+            scan_id = hashlib.sha1(result.encode()).hexdigest()[:8]
+            self._scan_store[scan_id] = result
+        elif fname == "get_last_scan" and result.startswith("scan#"):
+            self._stash_last_scan()
+            scan_id = result[len("scan#"):].split(" ", 1)[0]
+
+        # get_last_scan pages its output itself
+        if len(result) > 20000 and fname != "get_last_scan":
+            hint = f"Call get_last_scan('{scan_id}') to read it in full." if scan_id else "Call scan_page again if needed."
+            result = result[:2000] + f"\n...[TRUNCATED DUE TO LENGTH]... {hint}"
+
+        msg = {
             "role": "tool",
             "tool_call_id": tool_id,
             "content": result
-        })
+        }
+        self._append_history(msg)
+
+        if scan_id:
+            self._last_scan = (msg, scan_id)
+
+    def _stash_last_scan(self):
+        """Replaces the previous full scan (or get_last_scan page) in history with a short reference to it."""
+        if not self._last_scan: return
+        msg, scan_id = self._last_scan
+        self._last_scan = None
+
+        for i, m in enumerate(self.history):
+            if m is msg:
+                header = self._scan_store[scan_id].split("\n", 1)[0].rstrip(":")
+                stub = {**msg, "content": f"scan#{scan_id}: {header}. Use get_last_scan('{scan_id}') to re-read."}
+                tokens = len(self._enc.encode(self._message_text(stub)))
+                self.history[i] = stub
+                self._tok_sum += tokens - self._tok_counts[i]
+                self._tok_counts[i] = tokens
+                break
 
     def _tool_mark_done(self, result_summary: str):
         if self.plan:
@@ -187,12 +388,29 @@ class Agent:
         self.notes.append(f"Step done: {result_summary}")
         return "Step marked done."
 
+    def _tool_get_last_scan(self, scan_id: str, offset: int = 0):
+        scan_id = scan_id.removeprefix("scan#")
+        scan = self._scan_store.get(scan_id)
+        if scan is None:
+            return f"Error: scan#{scan_id} not found. Call 'scan_page'."
+
+        offset = max(0, offset)
+        chunk = scan[offset:offset + 20000]
+        end = offset + len(chunk)
+        # The scan# header lets _add_tool_result stub this page out later like a scan
+        page = f"scan#{scan_id} [{offset}-{end} of {len(scan)}]:\n{chunk}"
+        if end < len(scan):
+            page += f"\n...[{len(scan) - end} more chars]... Call get_last_scan('{scan_id}', offset={end}) to continue."
+        return page
+
     def _tool_finish(self, final_result: str):
         return "Finished."
 
-    def _tool_ask_user(self, question: str):
-        console.print(Panel(question, title="❓ Question", style="magenta"))
-        ans = console.input("[bold magenta]Answer > [/bold magenta]")
+    async def _tool_ask_user(self, question: str):
+        async with self._ask_lock:
+            console.print(Panel(question, title="❓ Question", style="magenta"))
+            console.print("[bold magenta]Answer > [/bold magenta]", end="")
+            ans = await ainput()
         self.notes.append(f"User Clarification (Q: {question} | A: {ans})")
         return f"User Answer: {ans}"
 
@@ -243,53 +461,7 @@ class Agent:
                     """
 
     def _get_tool_definitions(self, role: str) -> List[dict]:
-        if role == "PLANNER":
-            return [{
-                "type": "function",
-                "function": {
-                    "name": "set_plan",
-                    "description": "Set execution steps.",
-                    "parameters": {"type": "object",
-                                   "properties": {"steps": {"type": "array", "items": {"type": "string"}}},
-                                   "required": ["steps"]}
-                }
-            }, {
-                "type": "function",
-                "function": {
-                    "name": "ask_user",
-                    "description": "Ask clarification.",
-                    "parameters": {"type": "object", "properties": {"question": {"type": "string"}},
-                                   "required": ["question"]}
-                }
-            }]
-
-        return [
-            {"type": "function", "function": {"name": "open_url", "parameters": {"type": "object", "properties": {
-                "url": {"type": "string"}}, "required": ["url"]}}},
-            {"type": "function", "function": {"name": "scan_page",
-                                              "description": "Get interactive elements map.",
-                                              "parameters": {"type": "object", "properties": {}}}},
-            {"type": "function", "function": {"name": "click_element", "parameters": {"type": "object", "properties": {
-                "element_id": {"type": "integer"}}, "required": ["element_id"]}}},
-            {"type": "function", "function": {"name": "type_text", "parameters": {"type": "object", "properties": {
-                "element_id": {"type": "integer"}, "text": {"type": "string"},
-                "submit": {"type": "boolean", "description": "Press Enter after typing? Default True"}},
-                                                                                  "required": ["element_id", "text"]}}},
-            {"type": "function", "function": {"name": "scroll", "parameters": {"type": "object", "properties": {
-                "direction": {"type": "string", "enum": ["up", "down"]}}, "required": ["direction"]}}},
-            {"type": "function",
-             "function": {"name": "mark_step_done", "description": "Call when step is done.",
-                          "parameters": {"type": "object", "properties": {"result_summary": {"type": "string"}},
-                                         "required": ["result_summary"]}}},
-            {"type": "function",
-             "function": {"name": "finish_task", "description": "Call when ALL steps are done.",
-                          "parameters": {"type": "object", "properties": {"final_result": {"type": "string"}},
-                                         "required": ["final_result"]}}},
-            {"type": "function", "function": {"name": "get_tabs", "parameters": {"type": "object", "properties": {}}}},
-            {"type": "function", "function": {"name": "switch_tab", "parameters": {"type": "object", "properties": {
-                "idx": {"type": "integer"}}, "required": ["idx"]}}},
-            {"type": "function", "function": {"name": "close_tab", "parameters": {"type": "object", "properties": {}}}}
-        ]
+        return self._TOOLS_PLANNER if role == "PLANNER" else self._TOOLS_WORKER
 
     def _get_error_hint(self, fname: str, error_msg: str) -> str:
         hint = "\n\n💡 ADAPTIVE STRATEGY: "
@@ -1,18 +1,46 @@
 import os
 import asyncio
-from typing import Optional
-from playwright.async_api import async_playwright, Playwright, Browser, BrowserContext, Page, Locator
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Tuple, List
+from playwright.async_api import async_playwright, Playwright, Browser, BrowserContext, Page, Locator, CDPSession
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
 from config import cfg
-from .accessibility import AccessibilityParser
+from .accessibility import AccessibilityParser, ElementInfo
 
 
 class BrowserService:
+    OVERLAY_SELECTORS = [
+        "button[aria-label='Закрыть']",
+        "div[data-apiary-widget-name='RegionPopup'] button",
+        ".Cookie-Button",
+        "button:has-text('Принять')",
+        "button:has-text('Понятно')"
+    ]
+
+    # Bumped on every DOM mutation so cached scans expire when the page changes on its own.
+    # Runs in its own isolated world: page scripts see neither the counter nor the observer.
+    DOM_VERSION_WORLD = "agent_dom_version"
+    DOM_VERSION_SCRIPT = """
+        if (window.__agentDomVersion === undefined) {
+            window.__agentDomVersion = 0;
+            new MutationObserver(() => { window.__agentDomVersion++; })
+                .observe(document, {childList: true, subtree: true, attributes: true, characterData: true});
+        }
+    """
+
     def __init__(self):
         self.playwright: Optional[Playwright] = None
         self.browser: Optional[Browser] = None
         self.context: Optional[BrowserContext] = None
         self.page: Optional[Page] = None
         self.parser = AccessibilityParser()
+        self._overlay_selector = ", ".join(f"{sel}:visible" for sel in self.OVERLAY_SELECTORS)
+
+        self._nav_counters: Dict[Page, int] = {}
+        self._ax_cache: Dict[Page, Tuple[Tuple[str, int, int], str, Dict[int, ElementInfo]]] = {}
+        self._cdp: Dict[Page, CDPSession] = {}
+        # nav counter at which the page was last seen without overlays
+        self._dismissed: Dict[Page, int] = {}
 
     async def start(self):
         self.playwright = await async_playwright().start()
@@ -21,7 +49,16 @@ class BrowserService:
             channel="chrome",
             args=cfg.BROWSER_ARGS
         )
+        await self._open_context()
 
+    async def fork(self) -> "BrowserService":
+        """Opens an isolated context on the already running browser."""
+        tab = BrowserService()
+        tab.browser = self.browser
+        await tab._open_context()
+        return tab
+
+    async def _open_context(self):
         state = cfg.STORAGE_STATE if os.path.exists(cfg.STORAGE_STATE) else None
 
         self.context = await self.browser.new_context(
@@ -35,34 +72,60 @@ class BrowserService:
 
         self.context.on("page", self._handle_new_tab)
         self.page = await self.context.new_page()
+        self._watch_page(self.page)
 
     async def stop(self):
+        # Forked tabs share the browser and leave the session file to its owner
+        owner = self.playwright is not None
+        for page in list(self._cdp):
+            await self._detach_cdp(page)
         if self.context:
-            await self.context.storage_state(path=cfg.STORAGE_STATE)
+            if owner: await self.context.storage_state(path=cfg.STORAGE_STATE)
             await self.context.close()
-        if self.browser: await self.browser.close()
-        if self.playwright: await self.playwright.stop()
+        if owner:
+            if self.browser: await self.browser.close()
+            await self.playwright.stop()
 
     async def open_url(self, url: str) -> str:
         if not self.page: return "Browser not started."
         if not url.startswith("http"): url = "https://" + url
         try:
             await self.page.goto(url, wait_until="domcontentloaded", timeout=cfg.TIMEOUT)
-            await asyncio.sleep(2)
+            try:
+                # Busy sites never go idle; the cap keeps the old 2s worst case
+                await self.page.wait_for_load_state("networkidle", timeout=2000)
+            except PlaywrightTimeoutError:
+                pass
             await self._dismiss_overlays()
             return f"Opened {url} - Title: {await self.page.title()}"
         except Exception as e:
             return f"Error opening url: {e}"
 
-    async def scan_page(self) -> str:
+    async def scan_page(self, diff: bool = False) -> str:
         if not self.page: return "No page."
         await self._dismiss_overlays()
-        return await self.parser.scan(self.page)
+        previous = dict(self.parser.elements_map)
+
+        key = await self._scan_key(self.page)
+        cached = self._ax_cache.get(self.page)
+        if key and cached and cached[0] == key:
+            self.parser.elements_map = dict(cached[2])
+            report = cached[1]
+        else:
+            report = await self.parser.scan(await self._cdp_session(self.page))
+            if key and self.parser.elements_map:
+                self._ax_cache[self.page] = (key, report, dict(self.parser.elements_map))
+
+        if diff and previous and self.parser.elements_map:
+            return self.parser.diff(previous)
+        return report
 
     async def click_element(self, element_id: int) -> str:
         """
         Adaptive Click:
-        1. Try normal click.
+        0. If the scan recorded the DOM node -> real mouse click at the centre of
+           its box (located via CDP, so duplicate role/name pairs can't mislead it).
+        1. If the node is gone, has no box, is covered or disabled -> normal click by role/name.
         2. If obscured/outside viewport -> Scroll & Force Click.
         3. If selector fails -> Try searching by Text content.
         4. If still fails -> Try JavaScript dispatchEvent.
@@ -70,6 +133,15 @@ class BrowserService:
         el_info = self.parser.elements_map.get(element_id)
         if not el_info: return f"❌ Error: ID {element_id} not found. Suggestion: Call 'scan_page' to refresh IDs."
 
+        self._invalidate(self.page)
+
+        if el_info.backend_node_id:
+            try:
+                await self._click_backend_node(el_info.backend_node_id)
+                return f"✅ Clicked {el_info.role} '{el_info.name}' (by node id)"
+            except Exception:
+                pass  # Node gone, covered or disabled -> fall back to role/name lookup
+
         if el_info.name:
             loc = self.page.get_by_role(el_info.role, name=el_info.name).first
         else:
@@ -103,6 +175,8 @@ class BrowserService:
         el_info = self.parser.elements_map.get(element_id)
         if not el_info: return f"ID {element_id} not found."
 
+        self._invalidate(self.page)
+
         try:
             locator = self.page.get_by_role(el_info.role, name=el_info.name).first
             await locator.click(force=True)
@@ -118,6 +192,7 @@ class BrowserService:
     async def scroll(self, direction: str) -> str:
         if not self.page: return "No page."
         delta = 800 if direction == "down" else -800
+        self._invalidate(self.page)
         await self.page.mouse.wheel(0, delta)
         await asyncio.sleep(0.5)
         return f"Scrolled {direction}."
@@ -135,30 +210,138 @@ class BrowserService:
 
     async def close_tab(self) -> str:
         if not self.context or len(self.context.pages) <= 1: return "Cannot close last tab."
+        self._nav_counters.pop(self.page, None)
+        self._ax_cache.pop(self.page, None)
+        self._dismissed.pop(self.page, None)
+        await self._detach_cdp(self.page)
         await self.page.close()
         self.page = self.context.pages[-1]
         return "Tab closed."
 
     async def _handle_new_tab(self, page: Page):
+        self._watch_page(page)
         await page.wait_for_load_state("domcontentloaded")
         self.page = page
 
+    async def _cdp_session(self, page: Page) -> CDPSession:
+        """One CDP session per page, opened on first use and reused by every later scan."""
+        cdp = self._cdp.get(page)
+        if not cdp:
+            cdp = self._cdp[page] = await self.context.new_cdp_session(page)
+            await cdp.send("Page.addScriptToEvaluateOnNewDocument",
+                           {"source": self.DOM_VERSION_SCRIPT, "worldName": self.DOM_VERSION_WORLD})
+        return cdp
+
+    async def _click_backend_node(self, backend_node_id: int):
+        """Trusted mouse click at the centre of the node's box; raises if the point would miss it."""
+        cdp = await self._cdp_session(self.page)
+        await cdp.send("DOM.scrollIntoViewIfNeeded", {"backendNodeId": backend_node_id})
+        quads = (await cdp.send("DOM.getContentQuads", {"backendNodeId": backend_node_id}))["quads"]
+        if not quads:
+            raise RuntimeError("Node has no layout box")
+        quad = quads[0]
+        x, y = sum(quad[0::2]) / 4, sum(quad[1::2]) / 4
+
+        # Refuse points covered by another element or disabled controls, so the Playwright path reports why
+        node = await cdp.send("DOM.resolveNode", {"backendNodeId": backend_node_id})
+        object_id = node["object"]["objectId"]
+        try:
+            hit = await cdp.send("Runtime.callFunctionOn", {
+                "objectId": object_id,
+                "functionDeclaration": "function(x, y) { const e = document.elementFromPoint(x, y);"
+                                       " return !this.disabled && !!e && this.contains(e); }",
+                "arguments": [{"value": x}, {"value": y}],
+                "returnByValue": True
+            })
+        finally:
+            await cdp.send("Runtime.releaseObject", {"objectId": object_id})
+        if not hit.get("result", {}).get("value"):
+            raise RuntimeError("Node is obscured or disabled")
+
+        await self.page.mouse.click(x, y)
+
+    async def _detach_cdp(self, page: Page):
+        cdp = self._cdp.pop(page, None)
+        if not cdp: return
+        try:
+            await cdp.detach()
+        except Exception:
+            pass
+
+    def _watch_page(self, page: Page):
+        """Bumps the page's nav counter on every main-frame navigation so cached scans expire."""
+        if page in self._nav_counters: return
+        self._nav_counters[page] = 0
+        page.on("framenavigated", lambda frame: self._invalidate(page) if frame == page.main_frame else None)
+
+    async def _scan_key(self, page: Page) -> Optional[Tuple[str, int, int]]:
+        """(url, nav counter, DOM version); None means the DOM version is unknown and the cache must not be used."""
+        try:
+            cdp = await self._cdp_session(page)
+            frame_id = (await cdp.send("Page.getFrameTree"))["frameTree"]["frame"]["id"]
+            # Returns the existing world of that name; the script installs the counter if the
+            # document predates the session (counting then starts now, which is still sound)
+            world = await cdp.send("Page.createIsolatedWorld", {"frameId": frame_id, "worldName": self.DOM_VERSION_WORLD})
+            result = await cdp.send("Runtime.evaluate", {
+                "expression": self.DOM_VERSION_SCRIPT + "window.__agentDomVersion",
+                "contextId": world["executionContextId"],
+                "returnByValue": True
+            })
+            dom_version = result.get("result", {}).get("value")
+        except Exception:
+            return None
+        if dom_version is None: return None
+        return page.url, self._nav_counters.get(page, 0), dom_version
+
+    def _invalidate(self, page: Page):
+        self._nav_counters[page] = self._nav_counters.get(page, 0) + 1
+
     async def _dismiss_overlays(self):
         if not self.page: return
+        version = self._nav_counters.get(self.page, 0)
+        if self._dismissed.get(self.page) == version: return
         try:
-            selectors = [
-                "button[aria-label='Закрыть']",
-                "div[data-apiary-widget-name='RegionPopup'] button",
-                ".Cookie-Button",
-                "button:has-text('Принять')",
-                "button:has-text('Понятно')"
-            ]
-            for sel in selectors:
-                try:
-                    loc = self.page.locator(sel).first
-                    if await loc.is_visible(timeout=500):
-                        await loc.click(force=True)
-                except Exception as e:
-                    return f"Failed: {e}"
+            loc = self.page.locator(self._overlay_selector).first
+            if await loc.is_visible(timeout=500):
+                await loc.click(force=True)
+                self._invalidate(self.page)
+            else:
+                self._dismissed[self.page] = version
         except Exception as e:
-            return f"Failed: {e}"
\ No newline at end of file
+            return f"Failed: {e}"
+
+
+class TabPool:
+    """Hands out pre-warmed isolated tabs of one BrowserService so several agents can run concurrently."""
+
+    def __init__(self, browser: BrowserService, size: int):
+        self.browser = browser
+        self.size = max(1, size)
+        self.free: asyncio.Queue = asyncio.Queue()
+        self.forks: List[BrowserService] = []
+
+    async def start(self):
+        self.free.put_nowait(self.browser)
+        for _ in range(self.size - 1):
+            tab = await self.browser.fork()
+            self.forks.append(tab)
+            self.free.put_nowait(tab)
+
+    async def stop(self):
+        for tab in self.forks:
+            await tab.stop()
+        self.forks.clear()
+
+    async def acquire(self) -> BrowserService:
+        return await self.free.get()
+
+    def release(self, tab: BrowserService):
+        self.free.put_nowait(tab)
+
+    @asynccontextmanager
+    async def tab(self):
+        tab = await self.acquire()
+        try:
+            yield tab
+        finally:
+            self.release(tab)